@@ -1,6 +1,7 @@
 import os
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
 # from flask_migrate import Migrate
 
 from .config import Config
@@ -14,4 +15,21 @@ app.config.from_object(Config)
 db = SQLAlchemy(app)
 # migrate = Migrate(app, db)
 
+
+@event.listens_for(db.engine, 'connect')
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    SQLite connections aren't pooled, so set the pragmas on every new
+    connection.  WAL lets the pages read while receiver functions are being
+    written and, with synchronous=NORMAL, only syncs to disk on checkpoints
+    instead of on every commit.
+    """
+    if db.engine.dialect.name != 'sqlite':
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
 from rfpy import views, models
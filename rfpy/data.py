@@ -1,4 +1,5 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 from obspy import UTCDateTime, read_events, read_inventory
 from obspy.clients.fdsn import Client
@@ -122,7 +123,7 @@ def get_events(data_path=os.getcwd(), add_to_db=False, **kwargs):
 
 
 def get_data(staxml, quakeml, data_path=os.getcwd(), add_to_db=False,
-             **kwargs):
+             threads_per_client=5, **kwargs):
     """
     Request event data from an obspy client.  Reads an earthquake and a station
     file and downloads waveforms from stations that are between 30 and 90
@@ -133,6 +134,8 @@ def get_data(staxml, quakeml, data_path=os.getcwd(), add_to_db=False,
     :username: FDSN username for restricted data (If needed)
     :password: FDSN password for restricted data (If needed)
     :add_to_db: Add data to the flask database associated with the rfpy project
+    :threads_per_client: Number of concurrent waveform requests sent to the
+        client for each event
     """
     if 'username' and 'password' in kwargs:
         client = init_client(username=kwargs['username'],
@@ -169,90 +172,99 @@ def get_data(staxml, quakeml, data_path=os.getcwd(), add_to_db=False,
         for i in query:
             sta_dict[i.station] = i.id
 
-    for event in cat:
-        # temporary status update to be polled by frontend
-        cnt += 1
-        dl_perc = int(100*cnt/cat_size)
-        dl_progress_q = False
-        if add_to_db:
-            dl_progress = ProgressStatus.query.filter_by(
-                                               name='download').first()
-            if dl_progress:
-                dl_progress.progress = dl_perc
-            else:
-                dl_progress_q = ProgressStatus(name='download',
-                                               progress=dl_perc)
-
-            if dl_progress_q:
-                db.session.add(dl_progress_q)
-            db.session.commit()
-
-        origin_time = event.origins[0].time.strftime("%Y-%m-%dT%H:%M:%S")
-        if not os.path.exists(os.path.join(data_path, 'Data',
-                              origin_time)):
-            os.mkdir(os.path.join(data_path, 'Data', origin_time))
-            os.mkdir(os.path.join(data_path, 'Data', origin_time, 'RAW'))
-            os.mkdir(os.path.join(data_path, 'Data', origin_time, 'RF'))
-
-        for net in inv:
-            for sta in net:
-                sta_lat = sta.latitude
-                sta_lon = sta.longitude
-                ev_lat = event.origins[0].latitude
-                ev_lon = event.origins[0].longitude
-                ev_time = UTCDateTime(event.origins[0].time)
-                ev_dep_km = event.origins[0].depth/1000.0
-                dist_deg = kilometer2degrees(gps2dist_azimuth(sta_lat,
-                                             sta_lon, ev_lat,
-                                             ev_lon)[0]/1000)
-                if dist_deg > 30 and dist_deg < 90:
-                    arr = model.get_travel_times(source_depth_in_km=ev_dep_km,
-                                                 distance_in_degree=dist_deg,
-                                                 phase_list=['P'])
-                    start_time = ev_time + arr[0].time - 100
-                    end_time = ev_time + arr[0].time + 300
-                    rayp = arr[0].ray_param/6371.0
-                    take_angle = arr[0].takeoff_angle
-                    inc_angle = arr[0].incident_angle
-                    try:
+    with ThreadPoolExecutor(max_workers=threads_per_client) as executor:
+        for event in cat:
+            # temporary status update to be polled by frontend
+            cnt += 1
+            dl_perc = int(100*cnt/cat_size)
+            dl_progress_q = False
+            if add_to_db:
+                dl_progress = ProgressStatus.query.filter_by(
+                                                   name='download').first()
+                if dl_progress:
+                    dl_progress.progress = dl_perc
+                else:
+                    dl_progress_q = ProgressStatus(name='download',
+                                                   progress=dl_perc)
+
+                if dl_progress_q:
+                    db.session.add(dl_progress_q)
+                db.session.commit()
+
+            origin_time = event.origins[0].time.strftime("%Y-%m-%dT%H:%M:%S")
+            if not os.path.exists(os.path.join(data_path, 'Data',
+                                  origin_time)):
+                os.mkdir(os.path.join(data_path, 'Data', origin_time))
+                os.mkdir(os.path.join(data_path, 'Data', origin_time, 'RAW'))
+                os.mkdir(os.path.join(data_path, 'Data', origin_time, 'RF'))
+
+            ev_lat = event.origins[0].latitude
+            ev_lon = event.origins[0].longitude
+            ev_time = UTCDateTime(event.origins[0].time)
+            ev_dep_km = event.origins[0].depth/1000.0
+            # Find the stations in range and send their waveform requests to
+            # the thread pool.  Only the downloads run in threads, writing
+            # files and database rows stays in this thread.
+            pending = []
+            for net in inv:
+                for sta in net:
+                    sta_lat = sta.latitude
+                    sta_lon = sta.longitude
+                    dist_deg = kilometer2degrees(gps2dist_azimuth(sta_lat,
+                                                 sta_lon, ev_lat,
+                                                 ev_lon)[0]/1000)
+                    if dist_deg > 30 and dist_deg < 90:
+                        arr = model.get_travel_times(
+                            source_depth_in_km=ev_dep_km,
+                            distance_in_degree=dist_deg, phase_list=['P'])
                         # Request data from client using 100 seconds before P
                         # and 300 seconds after P
-                        st = client.get_waveforms(net.code, sta.code, location,
-                                                  channel, start_time,
-                                                  end_time, **kwargs)
-                        ev_dir = os.path.join(data_path, "Data", origin_time,
-                                              'RAW')
-                        st = _check_st_len(st)
-                        _check_ZNE(st, inv)
-                        st.write(f'{ev_dir}/{net.code}_{sta.code}.mseed')
-                        if add_to_db:
-                            sta_id = sta_dict[f'{net.code}_{sta.code}']
-                            ev_id = event.resource_id.id
-                            eq_query = Earthquakes.query.\
-                                filter_by(resource_id=ev_id).first()
-                            eq_query_id = eq_query.id
-                            dat = RawData(sta_id=sta_id,
-                                          earthquake_id=eq_query_id,
-                                          path=f'{ev_dir}/{net.code}_'
-                                               f'{sta.code}.mseed',
-                                               new_data=True)
-                            arrival = Arrivals(arr_type='P',
-                                               time=str(ev_time+arr[0].time),
-                                               station_id=sta_id,
-                                               eq_id=eq_query_id, rayp=rayp,
-                                               inc_angle=inc_angle,
-                                               take_angle=take_angle)
-                            # Check if event is currently marked as used.
-                            # If not change the utilized col in Earthquakes
-                            if ev_id not in utilized_events:
-                                eq_query.utilized = True
-
-                            db.session.add(dat)
-                            db.session.add(arrival)
-                            db.session.commit()
-                    except Exception as e:
-                        # TODO: Catch proper exception act accordingly
-                        pass
+                        start_time = ev_time + arr[0].time - 100
+                        end_time = ev_time + arr[0].time + 300
+                        future = executor.submit(client.get_waveforms,
+                                                 net.code, sta.code, location,
+                                                 channel, start_time,
+                                                 end_time, **kwargs)
+                        pending.append((net, sta, arr[0], future))
+
+            for net, sta, arr, future in pending:
+                rayp = arr.ray_param/6371.0
+                take_angle = arr.takeoff_angle
+                inc_angle = arr.incident_angle
+                try:
+                    st = future.result()
+                    ev_dir = os.path.join(data_path, "Data", origin_time,
+                                          'RAW')
+                    st = _check_st_len(st)
+                    _check_ZNE(st, inv)
+                    raw_path = f'{ev_dir}/{net.code}_{sta.code}.mseed'
+                    st.write(raw_path)
+                    if add_to_db:
+                        sta_id = sta_dict[f'{net.code}_{sta.code}']
+                        ev_id = event.resource_id.id
+                        eq_query = Earthquakes.query.\
+                            filter_by(resource_id=ev_id).first()
+                        eq_query_id = eq_query.id
+                        dat = RawData(sta_id=sta_id,
+                                      earthquake_id=eq_query_id,
+                                      path=raw_path, new_data=True)
+                        arrival = Arrivals(arr_type='P',
+                                           time=str(ev_time+arr.time),
+                                           station_id=sta_id,
+                                           eq_id=eq_query_id, rayp=rayp,
+                                           inc_angle=inc_angle,
+                                           take_angle=take_angle)
+                        # Check if event is currently marked as used.
+                        # If not change the utilized col in Earthquakes
+                        if ev_id not in utilized_events:
+                            eq_query.utilized = True
+
+                        db.session.add(dat)
+                        db.session.add(arrival)
+                        db.session.commit()
+                except Exception as e:
+                    # TODO: Catch proper exception act accordingly
+                    pass
 
 
 def _async_get_data(app, **kwargs):
@@ -47,7 +47,7 @@ def phaseshift(x, nfft, dt, tshift):
 
 
 def decovit(uin, win, dt, nt=None, tshift=10, f0=2.0, itmax=400, minderr=0.001,
-            info=False):
+            info=False, dtype=np.float64):
     """
     Created on Wed Sep 10 14:21:38 2014
     [RFI, rms, it]=makeRFitdecon(uin,win,dt,nt,tshift,f0,itmax,minderr)
@@ -61,6 +61,7 @@ def decovit(uin, win, dt, nt=None, tshift=10, f0=2.0, itmax=400, minderr=0.001,
     f0 = width of gaussian filter
     itmax = max # iterations
     minderr = Min change in error required for stopping iterations
+    dtype = Floating point type used for the working arrays and output
 
     Out:
     RFI = receiver function
@@ -76,17 +77,17 @@ def decovit(uin, win, dt, nt=None, tshift=10, f0=2.0, itmax=400, minderr=0.001,
     else:
         pass
 
-    rms = np.zeros(itmax)
+    rms = np.zeros(itmax, dtype=dtype)
     nfft = next_pow_2(nt)
-    p0 = np.zeros(nfft)
+    p0 = np.zeros(nfft, dtype=dtype)
 
-    u0 = np.zeros(nfft)
-    w0 = np.zeros(nfft)
+    u0 = np.zeros(nfft, dtype=dtype)
+    w0 = np.zeros(nfft, dtype=dtype)
 
     u0[0:nt] = uin
     w0[0:nt] = win
 
-    gaussF = gaussFilter(dt, nfft, f0)
+    gaussF = gaussFilter(dt, nfft, f0).astype(dtype, copy=False)
 
     u_flt = gfilter(u0, nfft, gaussF, dt)
     w_flt = gfilter(w0, nfft, gaussF, dt)
@@ -124,7 +125,7 @@ def decovit(uin, win, dt, nt=None, tshift=10, f0=2.0, itmax=400, minderr=0.001,
 
     p_flt = gfilter(p0, nfft, gaussF, dt)
     p_flt = phaseshift(p_flt, nfft, dt, tshift)
-    RFI = p_flt[0:nt]
+    RFI = p_flt[0:nt].astype(dtype, copy=False)
     rms = rms[0:it - 1]
 
     return RFI, rms, it
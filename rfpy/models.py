@@ -129,6 +129,9 @@ class Filters(db.Model):
 
 
 class HKResults(db.Model):
+    # One result per station and filter.  savehk relies on this to upsert
+    __table_args__ = (db.Index('ix_hk_results_station_filter', 'station',
+                               'filter', unique=True),)
     id = db.Column(db.Integer, primary_key=True)
     station = db.Column(db.Integer, db.ForeignKey('stations.id'))
     filter = db.Column(db.Integer, db.ForeignKey('filters.id'))
@@ -151,6 +154,10 @@ class HKResults(db.Model):
 
 
 class ReceiverFunctions(db.Model):
+    # The qc, hkstack and rfplots queries filter on these columns.  path is
+    # included so those queries can be answered from the index alone
+    __table_args__ = (db.Index('ix_rf_sta_filt_acc_new', 'station', 'filter',
+                               'accepted', 'new_receiver_function', 'path'),)
     id = db.Column(db.Integer, primary_key=True)
     station = db.Column(db.Integer, db.ForeignKey('stations.id'))
     filter = db.Column(db.Integer, db.ForeignKey('filters.id'))
@@ -4,6 +4,7 @@ import glob
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import numpy as np
 from obspy import Stream
 
@@ -249,30 +250,35 @@ def sta_total_rf_plot(st, plot_start=-2, plot_end=30, title=None,
     if title:
         plt.suptitle(title)
     plt.savefig(filename)
+    plt.close(fig)
 
 
 def base_map(projection='local', center_lat=0, center_lon=0, extent=None,
-             **kwargs):
+             fig=None, **kwargs):
     """
     Function to plot a basic map which can be used to add data later.
     :param projection: Cartopy projection string
     :param center_lat: Latitude to center map
     :param center_lon: Longitude to center map
     :param extent: List of coordinates for map boundaries
+    :param fig: Matplotlib Figure to draw on.  A new pyplot figure is created
+        if not given
     """
-    plt.figure()
+    if fig is None:
+        fig = plt.figure()
     if projection == 'global':
-        ax = plt.axes(projection=ccrs.Mollweide(central_longitude=center_lon))
+        ax = fig.add_subplot(projection=ccrs.Mollweide(
+                             central_longitude=center_lon))
     elif projection == 'local':
-        ax = plt.axes(projection=ccrs.AlbersEqualArea(
+        ax = fig.add_subplot(projection=ccrs.AlbersEqualArea(
             central_latitude=center_lat,
             central_longitude=center_lon))
         if extent:
             ax.set_extent(extent)
     elif projection == 'AzimuthalEquidistant':
-        ax = plt.axes(projection=ccrs.AzimuthalEquidistant(
-                      central_longitude=center_lon,
-                      central_latitude=center_lat))
+        ax = fig.add_subplot(projection=ccrs.AzimuthalEquidistant(
+                             central_longitude=center_lon,
+                             central_latitude=center_lat))
     else:
         print('Projection not supported')
     ax.coastlines()
@@ -369,7 +375,9 @@ def eq_map(eq_lats, eq_lons, center_lat, center_lon, filename=None):
 def hk_map(sta_lats, sta_lons, hk_vals, sta_names=None, filter=None,
            projection='local', filename=None):
     """
-    Plots a simple map of stations colored by HK stack results
+    Plots a simple map of stations colored by HK stack results.  When saving
+    to filename the map is drawn on its own Figure outside of pyplot, so maps
+    can be drawn from several threads at once.
     :param sta_lats: List of station latitudes
     :param sta_lons: List of station longitudes
     :param hk_vals: List of values for depths or kappas
@@ -380,15 +388,16 @@ def hk_map(sta_lats, sta_lons, hk_vals, sta_names=None, filter=None,
     center_lat = np.mean(sta_lats)
     center_lon = np.mean(sta_lons)
     data_crs = ccrs.Geodetic()
+    fig = Figure() if filename else None
     if projection == 'global':
         ax = base_map(projection='global', center_lat=0,
-                      center_lon=center_lon)
+                      center_lon=center_lon, fig=fig)
         im = ax.scatter(sta_lons, sta_lats, c=hk_vals, marker='v',
                         cmap='viridis', transform=data_crs)
     elif projection == 'local':
         extent = _calculate_extent_with_cushion(sta_lats, sta_lons)
         ax = base_map(projection='local', center_lat=center_lat,
-                      center_lon=center_lon, extent=extent)
+                      center_lon=center_lon, extent=extent, fig=fig)
         im = ax.scatter(sta_lons, sta_lats, c=hk_vals, marker='v',
                         cmap='viridis', transform=data_crs)
     if sta_names:
@@ -397,10 +406,9 @@ def hk_map(sta_lats, sta_lons, hk_vals, sta_names=None, filter=None,
             ax.text(sta_lons[i]-0.2, sta_lats[i]+0.1, name,
                     transform=data_crs)
     if filter:
-        plt.title(f'Filter: {filter}')
-    plt.colorbar(im, ax=ax)
+        ax.set_title(f'Filter: {filter}')
+    ax.figure.colorbar(im, ax=ax)
     if filename:
-        plt.savefig(filename)
-        plt.close()
+        fig.savefig(filename)
         return
     return ax
@@ -1,5 +1,9 @@
+import copy
+import io
 import os
 
+import numpy as np
+from lxml import etree
 from obspy import read, Trace, UTCDateTime, read_events, read_inventory
 from obspy.geodetics import gps2dist_azimuth, kilometer2degrees
 from obspy.taup import TauPyModel
@@ -122,6 +126,16 @@ def _rel_trim(st, before, after, reference='P'):
     return
 
 
+def _to_float32(st):
+    """
+    Internal function to cast the data of every trace in a stream to float32
+    in place.
+    :param st: Obspy stream
+    """
+    for tr in st:
+        tr.data = tr.data.astype(np.float32, copy=False)
+
+
 def _add_arrivals(st, use_db=True, model='iasp91'):
     """
     Internal function to calculate or retrieve the theoretical arrival times.
@@ -181,19 +195,23 @@ def rf_calc(st, prefilt=(0.05, 8), dt=0.1, gauss=[1.0], trim=(10, 100),
     back_azimuth = st[0].stats.rf['baz']
     _add_arrivals(st)
     _rel_trim(st, trim[0], trim[1])
+    # SAC output is float32, so there is no need to carry float64 samples
+    _to_float32(st)
     st.detrend('demean')
     st.detrend('linear')
     st.taper(max_percentage=0.05, max_length=0.2)
     st.filter(type='bandpass', freqmin=prefilt[0], freqmax=prefilt[1])
     st.interpolate(1/dt)
     st.rotate('NE->RT', back_azimuth=back_azimuth)
+    # filter and interpolate hand back float64 data
+    _to_float32(st)
     vert = st.select(component='Z')[0]
     radial = st.select(component='R')[0]
     trans = st.select(component='T')[0]
     rfs = []
     for g in gauss:
-        rad_rf_data = decovit(radial, vert, dt=dt, f0=g)
-        trans_rf_data = decovit(trans, vert, dt=dt, f0=g)
+        rad_rf_data = decovit(radial, vert, dt=dt, f0=g, dtype=np.float32)
+        trans_rf_data = decovit(trans, vert, dt=dt, f0=g, dtype=np.float32)
         rad_rf = Trace(rad_rf_data[0], header=radial.stats)
         rad_rf_rms = rad_rf_data[1][-1]
         trans_rf = Trace(trans_rf_data[0], header=trans.stats)
@@ -210,12 +228,15 @@ def rf_calc(st, prefilt=(0.05, 8), dt=0.1, gauss=[1.0], trim=(10, 100),
     return rfs
 
 
-def rfpy_calc_rf(st, data_path=os.getcwd(), rms_cutoff=0.15, **kwargs):
+def rfpy_calc_rf(st, data_path=os.getcwd(), rms_cutoff=0.15, commit=True,
+                 **kwargs):
     """
     Calculate receiver functions specifically for rfpy web app.  Saves
     receiver functions in data location under RF directory
     :param st: Obspy Stream containing 1 station 3 channels
     :param data_path: base directory for data
+    :param commit: Commit the session once the receiver functions are added.
+        Set to False when the caller manages the transaction
     """
     rfs = rf_calc(st, **kwargs)
     event = rfs[0][0].stats.rf['origin_time'].strftime("%Y-%m-%dT%H:%M:%S")
@@ -232,9 +253,10 @@ def rfpy_calc_rf(st, data_path=os.getcwd(), rms_cutoff=0.15, **kwargs):
             print(f"{g} not in filters table..Adding now")
             filter = Filters(filter=float(g))
             db.session.add(filter)
-            db.session.commit()
+            db.session.flush()
     # AFter filters checked get filter id adn write traces files to sac(others?
     # and add to receiver function db table
+    rf_rows = []
     for rf in rfs:
         gauss = rf[3]
         fname = f'{station}_{event}_{gauss}.eq'
@@ -250,19 +272,49 @@ def rfpy_calc_rf(st, data_path=os.getcwd(), rms_cutoff=0.15, **kwargs):
         trans_rf.write(f'{save_path}/{trans_name}', format="SAC")
         initial_accept = True if rms < rms_cutoff else False
 
-        rad_rf_db = ReceiverFunctions(station=sta_id, filter=filt_id,
-                                      path=f'{save_path}/{rad_name}',
-                                      new_receiver_function=True,
-                                      accepted=initial_accept)
-        trans_rf_db = ReceiverFunctions(station=sta_id, filter=filt_id,
-                                        path=f'{save_path}/{trans_name}',
-                                        new_receiver_function=True,
-                                        accepted=initial_accept)
-        db.session.add(rad_rf_db)
-        db.session.add(trans_rf_db)
+        for name in (rad_name, trans_name):
+            rf_rows.append({'station': sta_id, 'filter': filt_id,
+                            'path': f'{save_path}/{name}',
+                            'new_receiver_function': True,
+                            'accepted': initial_accept})
+    if rf_rows:
+        db.session.execute(ReceiverFunctions.__table__.insert(), rf_rows)
+    if commit:
         db.session.commit()
 
 
+def _read_needed_events(cat_path, resource_ids):
+    """
+    Stream a QuakeML file and only build obspy Events for the requested
+    resource ids.  Events that are not needed are discarded as they are
+    parsed so memory scales with the number of needed events rather than the
+    size of the catalog.
+    :param cat_path: Path to the QuakeML file
+    :param resource_ids: Set of event resource ids to keep
+    :return: Dictionary of resource_id: obspy Event
+    """
+    root = None
+    for _, elem in etree.iterparse(cat_path, events=('end',),
+                                   tag='{*}event'):
+        params = elem.getparent()
+        if root is None:
+            quakeml = params.getparent()
+            root = etree.Element(quakeml.tag, nsmap=quakeml.nsmap)
+            new_params = etree.SubElement(root, params.tag,
+                                          attrib=dict(params.attrib))
+        if elem.get('publicID') in resource_ids:
+            new_params.append(copy.deepcopy(elem))
+        # Free the parsed event and everything before it
+        elem.clear()
+        while elem.getprevious() is not None:
+            del params[0]
+
+    if root is None:
+        return {}
+    cat = read_events(io.BytesIO(etree.tostring(root)), format='QUAKEML')
+    return {ev.resource_id.id: ev for ev in cat}
+
+
 def _async_rf_calc(app, **kwargs):
     data = kwargs['data']
     rms_cut = kwargs['rms_cut']
@@ -270,23 +322,26 @@ def _async_rf_calc(app, **kwargs):
     kwargs.pop('rms_cut')
     inv_path = os.path.join(app.config["BASE_DIR"], 'Data/RFTN_Stations.xml')
     cat_path = os.path.join(app.config["BASE_DIR"], 'Data/RFTN_Catalog.xml')
-    inv = read_inventory(inv_path)
-    cat = read_events(cat_path)
-    for i, d in enumerate(data):
-        status = int(100*(i+1)/len(data))
-        st = read(d[0])
-        eq_id = d[1]
-        eq_time = Earthquakes.query.filter_by(id=eq_id).first().origin_time
-        origin_time = UTCDateTime(eq_time)
-        t1 = origin_time - 1
-        t2 = origin_time + 1
-        ev = cat.filter(f"time >= {t1}", f"time <= {t2}")[0]
-        set_stats(st, inv, ev)
-        rfpy_calc_rf(st, rms_cutoff=rms_cut, **kwargs)
-        stat_query = ProgressStatus.query.filter_by(name='rf').first()
-        if stat_query is not None:
-            stat_query.progress = status
-        else:
-            stat = ProgressStatus(name='rf', progress=status)
-            db.session.add(stat)
-        db.session.commit()
+    with app.app_context():
+        inv = read_inventory(inv_path)
+        eq_ids = {d[1] for d in data}
+        resource_ids = {eq.id: eq.resource_id for eq in
+                        Earthquakes.query.filter(
+                            Earthquakes.id.in_(eq_ids))}
+        event_by_id = _read_needed_events(cat_path,
+                                          set(resource_ids.values()))
+        for i, d in enumerate(data):
+            status = int(100*(i+1)/len(data))
+            st = read(d[0])
+            ev = event_by_id[resource_ids[d[1]]]
+            set_stats(st, inv, ev)
+            rfpy_calc_rf(st, rms_cutoff=rms_cut, commit=False, **kwargs)
+            stat_query = ProgressStatus.query.filter_by(name='rf').first()
+            if stat_query is not None:
+                stat_query.progress = status
+            else:
+                stat = ProgressStatus(name='rf', progress=status)
+                db.session.add(stat)
+            # One commit per event keeps the progress visible to the
+            # status polling
+            db.session.commit()
@@ -1,14 +1,38 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
 import click
 
 from obspy import UTCDateTime
+from sqlalchemy.dialects.sqlite import insert
 
 from rfpy import app, db
-from rfpy.data import get_stations, get_events, get_data
+from rfpy.data import get_stations, get_events, get_data, \
+                       check_data_directory
 from rfpy.models import Stations, ReceiverFunctions, Filters
 from rfpy.util import read_station_file, read_rftn_file, read_rftn_directory
 
 
+@lru_cache(maxsize=None)
+def _utc(time_string):
+    """ Parse a time string from the command line into a UTCDateTime """
+    return UTCDateTime(time_string)
+
+
+def _station_codes(station_file):
+    """
+    Read a station file and return the comma separated network and station
+    codes to request from the client
+    """
+    stas = read_station_file(station_file)
+    codes = [s['sta'].split('_', 1) for s in stas]
+    # Keep the order of the station file so the request is the same each run
+    nets = ','.join(dict.fromkeys(c[0] for c in codes))
+    stas = ','.join(dict.fromkeys(c[1] for c in codes))
+    return nets, stas
+
+
 @click.group()
 def cli():
     pass
@@ -18,6 +42,11 @@ def cli():
 def db_init():
     """ Create database """
     db.create_all()
+    # create_all skips tables that already exist, add indexes that are new
+    # since the database was created
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
 
 
 @cli.command('download_stations')
@@ -32,13 +61,13 @@ def download_stations(station_file, start_time, end_time, data_dir):
     The stationXML file will be downloaded to a Data folder located at the
     -d parameter.
     """
-    stas = read_station_file(station_file)
-    nets = ','.join(set([s[0].split('_')[0] for s in stas]))
-    stas = ','.join(set([s[0].split('_')[1] for s in stas]))
-    ts = UTCDateTime(start_time)
-    tf = UTCDateTime(end_time)
+    nets, stas = _station_codes(station_file)
+    ts = _utc(start_time)
+    tf = _utc(end_time)
+    # Station level metadata is fully covered by the FDSN text format, which
+    # is smaller to transfer and faster to parse than StationXML
     get_stations(data_path=data_dir, network=nets, station=stas, starttime=ts,
-                 endtime=tf, level='station')
+                 endtime=tf, level='station', format='text')
 
 
 @cli.command('download_events')
@@ -53,8 +82,8 @@ def download_events(minmagnitude, start_time, end_time, data_dir):
     greater than minmagnitude will be included in the catalog.  The quakeML
     file will be downloaded to a Data directory located in --data_dir.
     """
-    ts = UTCDateTime(start_time)
-    tf = UTCDateTime(end_time)
+    ts = _utc(start_time)
+    tf = _utc(end_time)
     get_events(data_path=data_dir, starttime=ts, endtime=tf,
                minmagnitude=minmagnitude)
 
@@ -65,39 +94,124 @@ def download_events(minmagnitude, start_time, end_time, data_dir):
 @click.option('-d', '--data_dir', default=os.getcwd())
 @click.option('-u', '--username')
 @click.option('-p', '--password')
-def download_data(staxml, quakeml, data_dir, username, password):
+@click.option('-t', '--threads-per-client', default=5)
+def download_data(staxml, quakeml, data_dir, username, password,
+                  threads_per_client):
     """
     Sets up the rfpy script to download actual waveform data.  Uses the
     stationXML file and the quakeML file from download_stations and
     download_events.  Data will be downloaded to a Data directory located in
-    --data_dir.
+    --data_dir.  --threads-per-client sets how many waveform requests are
+    sent to the client at once.
+    """
+    if username and password:
+        get_data(staxml, quakeml, data_path=data_dir, username=username,
+                 password=password, threads_per_client=threads_per_client)
+    else:
+        get_data(staxml, quakeml, data_path=data_dir,
+                 threads_per_client=threads_per_client)
+
+
+@cli.command('download_all')
+@click.option('-f', '--station_file', default='stas.txt')
+@click.option('-m', '--minmagnitude', default=5.5)
+@click.option('-ts', '--start_time', required=True)
+@click.option('-tf', '--end_time', required=True)
+@click.option('-d', '--data_dir', default=os.getcwd())
+@click.option('-u', '--username')
+@click.option('-p', '--password')
+@click.option('-t', '--threads-per-client', default=5)
+def download_all(station_file, minmagnitude, start_time, end_time, data_dir,
+                 username, password, threads_per_client):
+    """
+    Runs download_stations, download_events and download_data in one step.
+    The stationXML and quakeML requests do not depend on each other and are
+    downloaded at the same time.  Waveforms are downloaded once both files
+    exist.
     """
+    nets, stas = _station_codes(station_file)
+    ts = _utc(start_time)
+    tf = _utc(end_time)
+    # Create the Data directory here so the two downloads don't race on it
+    check_data_directory(data_dir)
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        sta_future = ex.submit(get_stations, data_path=data_dir, network=nets,
+                               station=stas, starttime=ts, endtime=tf,
+                               level='station', format='text')
+        ev_future = ex.submit(get_events, data_path=data_dir, starttime=ts,
+                              endtime=tf, minmagnitude=minmagnitude)
+        # result() re-raises any error from the download
+        sta_future.result()
+        ev_future.result()
+
+    staxml = os.path.join(data_dir, 'Data', 'RFTN_Stations.xml')
+    quakeml = os.path.join(data_dir, 'Data', 'RFTN_Catalog.xml')
     if username and password:
         get_data(staxml, quakeml, data_path=data_dir, username=username,
-                 password=password)
+                 password=password, threads_per_client=threads_per_client)
     else:
-        get_data(staxml, quakeml, data_path=data_dir)
+        get_data(staxml, quakeml, data_path=data_dir,
+                 threads_per_client=threads_per_client)
 
 
 @cli.command('add_stations')
 @click.option('-f', '--station_file', default='stas.txt')
 def add_stations(station_file):
     """ Add stations, dependent on station file, to database """
-    cnt = 0
     stas = read_station_file(station_file)
-    existing_stas = [s.station for s in Stations.query.all()]
-    for sta in stas:
-        if sta[0] not in existing_stas:
-            s = Stations(station=sta[0], latitude=sta[1], longitude=sta[2],
-                         elevation=sta[3], status='T')
-            db.session.add(s)
-            cnt += 1
-    # Fails if there are duplicates.  Need to catch the error and pass it on or
-    # query db first, and only add to session if station doesn't exist
+    mappings = [{'station': sta['sta'], 'latitude': sta['lat'],
+                 'longitude': sta['lon'], 'elevation': sta['ele'],
+                 'status': 'T'} for sta in stas]
+    # Stations already in the database, or repeated in the file, hit the
+    # unique constraint on station and are skipped
+    cnt = 0
+    if mappings:
+        stmt = insert(Stations).on_conflict_do_nothing(
+                                    index_elements=['station'])
+        cnt = db.session.execute(stmt, mappings).rowcount
     db.session.commit()
     print(f'Added {cnt} stations to the database')
 
 
+def _insert_rftns(rftns):
+    """
+    Add receiver functions, as returned by read_rftn_file or
+    read_rftn_directory, to the database.  Filters that are not yet in the
+    database are added.
+    :param rftns: Dictionary of stations receiver functions
+    :return: Number of filters and receiver functions added
+    """
+    filt_count = 0
+    rf_rows = []
+    sta_map = {s.station: s.id for s in Stations.query.all()}
+    filt_map = {f.filter: f.id for f in Filters.query.all()}
+    for key, sta_rftns in rftns.items():
+        sta_id = sta_map.get(key)
+        if sta_id is None:
+            raise LookupError("Station not in database: Please run "
+                              "add_stations command first")
+        for k, v in sta_rftns.items():
+            # Try to grab the filter id.  If it doesn't exist then add the
+            # filter to the database and get the id
+            filt_id = filt_map.get(float(k))
+            if filt_id is None:
+                # flush assigns the id without committing or re-querying
+                f = Filters(filter=float(k))
+                db.session.add(f)
+                db.session.flush()
+                filt_id = filt_map[f.filter] = f.id
+                filt_count += 1
+            for pth in v:
+                rf_rows.append({'station': sta_id, 'filter': filt_id,
+                                'path': pth,
+                                'new_receiver_function': True,
+                                'accepted': True})
+    if rf_rows:
+        db.session.execute(ReceiverFunctions.__table__.insert(), rf_rows)
+    db.session.commit()
+    return filt_count, len(rf_rows)
+
+
 @cli.command('add_rftns')
 @click.option('-f', '--rftn_file')
 @click.option('-p', '--data_path')
@@ -108,63 +222,13 @@ def add_rftns(rftn_file, data_path):
     for receiver functions to add
     """
     if rftn_file:
-        filt_count = 0
-        rf_count = 0
         rftns = read_rftn_file(rftn_file)
-        for key in rftns:
-            sta_id = Stations.query.filter_by(station=key).first().id
-            if not sta_id:
-                raise LookupError("Station not in database: Please run"
-                                  "add_stations command first")
-            for k, v in rftns[key].items():
-                # Try to grab the filter id.  If it doesn't exist then add the
-                # filter to the database and get the id
-                try:
-                    filt_id = Filters.query.filter_by(filter=k).first().id
-                except AttributeError:
-                    f = Filters(filter=k)
-                    db.session.add(f)
-                    db.session.commit()
-                    filt_id = Filters.query.filter_by(filter=k).first().id
-                    filt_count += 1
-                for pth in v:
-                    rf = ReceiverFunctions(station=sta_id, filter=filt_id,
-                                           path=pth,
-                                           new_receiver_function=True,
-                                           accepted=True)
-                    db.session.add(rf)
-                    rf_count += 1
-        db.session.commit()
+        filt_count, rf_count = _insert_rftns(rftns)
         print(f'Added {filt_count} Filters and {rf_count} receiver functions')
 
     if data_path:
-        filt_count = 0
-        rf_count = 0
         rftns = read_rftn_directory(data_path)
-        for key in rftns:
-            sta_id = Stations.query.filter_by(station=key).first().id
-            if not sta_id:
-                raise LookupError("Station not in database: Please run"
-                                  "add_stations command first")
-            for k, v in rftns[key].items():
-                # Try to grab the filter id.  If it doesn't exist then add the
-                # filter to the database and get the id
-                try:
-                    filt_id = Filters.query.filter_by(filter=k).first().id
-                except AttributeError:
-                    f = Filters(filter=k)
-                    db.session.add(f)
-                    db.session.commit()
-                    filt_id = Filters.query.filter_by(filter=k).first().id
-                    filt_count += 1
-                for pth in v:
-                    rf = ReceiverFunctions(station=sta_id, filter=filt_id,
-                                           path=pth,
-                                           new_receiver_function=True,
-                                           accepted=True)
-                    db.session.add(rf)
-                    rf_count += 1
-        db.session.commit()
+        filt_count, rf_count = _insert_rftns(rftns)
         print(f'Added {filt_count} Filters and {rf_count} receiver functions')
 
 
@@ -0,0 +1,58 @@
+import os
+
+import pytest
+from sqlalchemy import event
+
+from rfpy import db
+
+
+@pytest.fixture(scope='session')
+def app_db():
+    engine = db.engine
+
+    # pysqlite does not emit BEGIN itself which breaks SAVEPOINT.  Turn off
+    # its transaction handling and emit BEGIN from SQLAlchemy instead
+    @event.listens_for(engine, 'connect')
+    def _disable_pysqlite_begin(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def _emit_begin(conn):
+        conn.exec_driver_sql('BEGIN')
+
+    db.create_all()
+    yield db
+    db.session.remove()
+    db.drop_all()
+    os.remove('db/rftns.db')
+    os.rmdir('db')
+    os.rmdir('plots')
+    os.rmdir('exports')
+
+
+@pytest.fixture
+def txn(app_db):
+    """
+    Run a test inside a transaction that is rolled back afterwards.  Commits
+    made by the test only release a SAVEPOINT, which is restarted so the
+    test can keep committing.
+    """
+    connection = db.engine.connect()
+    trans = connection.begin()
+    session = db.create_scoped_session(options={'bind': connection,
+                                                'binds': {}})
+    nested = connection.begin_nested()
+
+    @event.listens_for(session, 'after_transaction_end')
+    def _restart_savepoint(sess, transaction):
+        nonlocal nested
+        if not nested.is_active:
+            nested = connection.begin_nested()
+
+    app_session = db.session
+    db.session = session
+    yield
+    db.session = app_session
+    session.remove()
+    trans.rollback()
+    connection.close()
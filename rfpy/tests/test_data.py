@@ -16,7 +16,7 @@ def test_get_stations():
     get_stations(network="PE", station="PAKC", starttime=ts, endtime=tf,
                  level="station")
     assert os.path.exists('Data/RFTN_Stations.xml')
-    inv = read_inventory('Data/RFTN_Stations.xml')
+    inv = read_inventory('Data/RFTN_Stations.xml', format='STATIONXML')
     assert len(inv) == 1
     assert inv[0].code == 'PE'
     assert inv[0][0].code == 'PAKC'
@@ -26,7 +26,7 @@ def test_get_events():
     ts, tf = setup()
     get_events(starttime=ts, endtime=tf, minmagnitude=6.0)
     assert os.path.exists('Data/RFTN_Catalog.xml')
-    cat = read_events('Data/RFTN_Catalog.xml')
+    cat = read_events('Data/RFTN_Catalog.xml', format='QUAKEML')
     assert len(cat) == 2
     assert cat[0].origins[0].latitude == -35.4756
     assert cat[1].origins[0].latitude == 5.6929
@@ -37,7 +37,7 @@ def test_get_data():
     assert os.path.exists('Data/2019-09-29T02:02:51')
     assert os.path.exists('Data/2019-09-29T15:57:53')
     assert os.path.exists('Data/2019-09-29T15:57:53/PE_PAKC.mseed')
-    st = read('Data/2019-09-29T15:57:53/PE_PAKC.mseed')
+    st = read('Data/2019-09-29T15:57:53/PE_PAKC.mseed', format='MSEED')
     assert len(st) == 3
     assert len(st[0]) == 40000
     assert st[0].stats.channel == 'HHE'
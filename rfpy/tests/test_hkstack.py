@@ -1,11 +1,18 @@
+from functools import lru_cache
+
 import numpy as np
 from obspy import read
 from rfpy.hkstack import HKStack
 
 
+@lru_cache(maxsize=1)
+def _read_test_stream():
+    return read('../../sampledata/TA/M54A/*1.0.eqr')
+
+
 def build_test_stream():
-    st = read('../../sampledata/TA/M54A/*1.0.eqr')
-    return st
+    # Tests may modify the stream so hand out a copy of the cached read
+    return _read_test_stream().copy()
 
 
 def test_set_hkgrid():
@@ -1,20 +1,11 @@
-import os
+import pytest
+from sqlalchemy.orm import joinedload
 
 from rfpy import db
 from rfpy.models import Stations, ReceiverFunctions, HKResults, Filters
 
-
-def setup_db():
-    db.create_all()
-
-
-def teardown_db():
-    db.session.remove()
-    db.drop_all()
-    os.remove('db/rftns.db')
-    os.rmdir('db')
-    os.rmdir('plots')
-    os.rmdir('exports')
+# Every test runs in a transaction that is rolled back, see conftest.py
+pytestmark = pytest.mark.usefixtures('txn')
 
 
 def test_stations():
@@ -49,7 +40,6 @@ def test_hkresult():
 
 
 def test_add_stations():
-    setup_db()
     sta = Stations(station='TA_M54A', latitude=41.444, longitude=-79.34,
                    elevation=345)
     db.session.add(sta)
@@ -86,10 +76,6 @@ def test_add_filters():
 
 
 def build_test_data():
-    # First drop and rebuild the tables from prior test
-    db.drop_all()
-    setup_db()
-
     # add more rftn, stations, hkresults, and filters
     sta = Stations(station='PE_PARS', latitude=-23.333, longitude=-99.999,
                    elevation=234.3)
@@ -104,36 +90,27 @@ def build_test_data():
                        savedhkpath='/some/other/path', h=44.5, sigmah=1.4,
                        k=1.77, sigmak=0.2, vp=6.2)
     # Add 5 rftn to 1st station
-    for i in range(5):
-        rftn = ReceiverFunctions(station=1, filter=1,
-                                 path='/some/path/to/data',
-                                 new_receiver_function=True, accepted=True)
-        db.session.add(rftn)
+    rftns = [ReceiverFunctions(station=1, filter=1,
+                               path=f'/some/path/to/data/1/{i}',
+                               new_receiver_function=True, accepted=True)
+             for i in range(5)]
     # Add 9 rftn to 2nd station and 2nd filter
-    for i in range(9):
-        rftn = ReceiverFunctions(station=2, filter=2,
-                                 path='/some/path/to/data',
-                                 new_receiver_function=True, accepted=True)
-        db.session.add(rftn)
+    rftns += [ReceiverFunctions(station=2, filter=2,
+                                path=f'/some/path/to/data/2/{i}',
+                                new_receiver_function=True, accepted=True)
+              for i in range(9)]
 
-    db.session.add(hk)
-    db.session.add(hk_two)
-    db.session.add(sta)
-    db.session.add(sta_two)
-    db.session.add(filt)
-    db.session.add(filt_two)
+    db.session.bulk_save_objects(rftns + [sta, sta_two, filt, filt_two, hk,
+                                          hk_two])
     db.session.commit()
 
 
 def test_relationships():
     build_test_data()
     # Stations and rf relationships, 1st station should have 5 rftn, 2nd 9
-    first_sta = Stations.query.get(1)
-    first_sta_receiver_functions = [i for i in first_sta.receiver_functions]
-    second_sta = Stations.query.get(2)
-    second_sta_receiver_functions = [i for i in second_sta.receiver_functions]
-    assert len(first_sta_receiver_functions) == 5
-    assert len(second_sta_receiver_functions) == 9
+    first_sta, second_sta = Stations.query.order_by(Stations.id).all()
+    assert first_sta.receiver_functions.count() == 5
+    assert second_sta.receiver_functions.count() == 9
 
     # Stations and hk relationship
     first_hk = [i for i in first_sta.hks]
@@ -145,23 +122,20 @@ def test_relationships():
     assert second_hk[0].h == 44.5
     assert second_hk[0].k == 1.77
 
-    first_filt = Filters.query.get(1)
-    first_filt_rf = [i for i in first_filt.receiver_functions]
-    second_filt = Filters.query.get(2)
-    second_filt_rf = [i for i in second_filt.receiver_functions]
-    assert len(first_filt_rf) == 5
-    assert len(second_filt_rf) == 9
+    first_filt, second_filt = Filters.query.order_by(Filters.id).all()
+    assert first_filt.receiver_functions.count() == 5
+    assert second_filt.receiver_functions.count() == 9
 
-    first_filt_hk = [i for i in first_filt.hks]
-    second_filt_hk = [i for i in second_filt.hks]
-    assert len(first_filt_hk) == 1
-    assert len(second_filt_hk) == 1
+    assert first_filt.hks.count() == 1
+    assert second_filt.hks.count() == 1
 
 
 def test_backref():
     build_test_data()
     # hk backrefs
-    hks = HKResults.query.all()
+    hks = HKResults.query.options(joinedload(HKResults.hk_station),
+                                  joinedload(HKResults.hk_filter)).order_by(
+                                  HKResults.id).all()
     backref_station_first = hks[0].hk_station
     backref_station_second = hks[1].hk_station
     backref_filt_first = hks[0].hk_filter
@@ -172,7 +146,10 @@ def test_backref():
     assert backref_filt_second.filter == 1.0
 
     # rftn backrefs
-    rfs = ReceiverFunctions.query.all()
+    rfs = ReceiverFunctions.query.options(
+        joinedload(ReceiverFunctions.station_receiver_functions),
+        joinedload(ReceiverFunctions.filter_receiver_functions)).order_by(
+        ReceiverFunctions.id).all()
     backref_station_first = rfs[0].station_receiver_functions
     backref_station_last = rfs[-1].station_receiver_functions
     backref_filt_first = rfs[0].filter_receiver_functions
@@ -181,5 +158,3 @@ def test_backref():
     assert backref_station_last.station == 'PE_PAKC'
     assert backref_filt_first.filter == 2.5
     assert backref_filt_last.filter == 1.0
-
-    teardown_db()
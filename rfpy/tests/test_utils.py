@@ -1,7 +1,10 @@
 import os
 import shutil
 
-from rfpy.util import read_station_file, read_rftn_file, read_rftn_directory
+from obspy import read
+
+from rfpy.util import read_station_file, read_rftn_file, read_rftn_directory,\
+                      rftn_stream
 
 
 def build_test_directory_structure():
@@ -62,8 +65,8 @@ def test_read_station_filt():
     build_test_station_file()
     stas = read_station_file('test_read_sta.txt')
     assert len(stas) == 3
-    assert stas[0][0] == 'TA_M55A'
-    assert stas[-1][-1] == '823.2'
+    assert stas[0]['sta'] == 'TA_M55A'
+    assert stas[-1]['ele'] == 823.2
 
 
 def test_read_rftn_file():
@@ -88,3 +91,19 @@ def test_read_rftn_directory():
     assert len(rfs['TA_O54A']['2.5']) == 1
     assert rfs['PE_PAKC']['5.0'][0] == f'{cur}/TestData/Data/PE_PAKC/5.0/tmp2'
     teardown_test_directory_structure()
+
+
+def test_rftn_stream_cache():
+    tr = read()[0]
+    tr.write('test_rftn.SAC', format='SAC')
+    st = rftn_stream(['test_rftn.SAC'])
+    assert st[0].stats.name == 'test_rftn.SAC'
+    st[0].data[:] = 0
+    st = rftn_stream(['test_rftn.SAC'])
+    assert st[0].data.any()
+    # Rewritten files are read again
+    tr.data = tr.data[:100]
+    tr.write('test_rftn.SAC', format='SAC')
+    st = rftn_stream(['test_rftn.SAC'])
+    assert st[0].stats.npts == 100
+    os.remove('test_rftn.SAC')
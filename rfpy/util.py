@@ -1,8 +1,19 @@
 import os
-import glob
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 
+import numpy as np
 from obspy import read, Stream
 
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+STATION_FILE_DTYPE = [('sta', 'U16'), ('lat', 'f8'), ('lon', 'f8'),
+                      ('ele', 'f8')]
+
 
 def read_station_file(stafile):
     """
@@ -15,16 +26,24 @@ def read_station_file(stafile):
 
     :param stafile: Name of input file
     :type stafile: str
-    :return: List of lists of stations... [[TA_M55A, 41.555, -77.555, 234.0],
-                                           [TA_M54A, 40.234, -78.092, 353.5]]
-    :rtype: List
+    :return: Structured array of stations with fields sta, lat, lon and ele
+        [('TA_M55A', 41.555, -77.555, 234.0),
+         ('TA_M54A', 40.234, -78.092, 353.5)]
+    :rtype: numpy.ndarray
     """
-
-    stas = []
-    with open(stafile, 'r') as f:
-        for line in f.readlines():
-            sta, lat, lon, ele = line.split()
-            stas.append([sta, lat, lon, ele])
+    if pd is None:
+        return np.loadtxt(stafile, dtype=STATION_FILE_DTYPE, ndmin=1)
+
+    # pandas' C parser is faster than loadtxt on large files when available
+    names = [name for name, _ in STATION_FILE_DTYPE]
+    try:
+        df = pd.read_csv(stafile, sep=r'\s+', header=None, names=names,
+                         comment='#', engine='c')
+    except pd.errors.EmptyDataError:
+        return np.empty(0, dtype=STATION_FILE_DTYPE)
+    stas = np.empty(len(df), dtype=STATION_FILE_DTYPE)
+    for name in names:
+        stas[name] = df[name].to_numpy()
     return stas
 
 
@@ -34,20 +53,15 @@ def read_rftn_file(rftn_file):
     :param rftn_file: file name to read
     :return data_paths: Dictionary of stations receiver functions
     """
-    data_paths = {}
+    data_paths = defaultdict(lambda: defaultdict(list))
     with open(rftn_file, 'r') as f:
-        for line in f.readlines():
+        for line in f:
             if line.startswith("#"):
                 continue
             station, filter, path = line.split()
-            if station not in data_paths:
-                data_paths[station] = {}
-            if filter not in data_paths[station]:
-                data_paths[station][filter] = []
-
             data_paths[station][filter].append(path)
 
-    return data_paths
+    return {station: dict(filts) for station, filts in data_paths.items()}
 
 
 def read_rftn_directory(basedir='.'):
@@ -65,33 +79,61 @@ def read_rftn_directory(basedir='.'):
     """
     data_paths = {}
     base = os.path.join(os.path.expanduser(basedir), 'Data')
-    stas = next(os.walk(base))[1]
-    for sta in stas:
-        if sta not in data_paths:
-            data_paths[sta] = {}
-
-        new_path = os.path.join(base, sta)
-        filts = next(os.walk(new_path))[1]
-
-        for filt in filts:
-            if filt not in data_paths[sta]:
-                data_paths[sta][filt] = []
-
-            rfs_path = os.path.join(new_path, filt)
-            rfs = glob.glob(f'{rfs_path}/*')
-            for rf in rfs:
-                data_paths[sta][filt].append(rf)
+    # DirEntry objects cache the file type from the directory listing, so no
+    # extra stat calls are made while walking the tree
+    with os.scandir(base) as stas:
+        for sta in stas:
+            if not sta.is_dir():
+                continue
+            sta_paths = data_paths[sta.name] = {}
+            with os.scandir(sta.path) as filts:
+                for filt in filts:
+                    if not filt.is_dir():
+                        continue
+                    rfs = sta_paths[filt.name] = []
+                    with os.scandir(filt.path) as entries:
+                        for rf in entries:
+                            if not rf.name.startswith('.') and rf.is_file():
+                                rfs.append(rf.path)
     return data_paths
 
 
-def rftn_stream(rftn_list):
+@lru_cache(maxsize=4096)
+def _load_rftn(rftn, mtime_ns, size, headonly):
+    """
+    Parse a receiver function.  Cached on the file's modification time and
+    size so a rewritten file is parsed again.
+    """
+    # Receiver functions are written as SAC, skip format detection
+    tr = read(rftn, format='SAC', headonly=headonly)[0]
+    tr.stats['name'] = rftn
+    return tr
+
+
+def _read_rftn(rftn, headonly=False):
+    """
+    Read a single receiver function and store its path in the stats
+    :param rftn: path to a receiver function
+    :param headonly: Only read the SAC header, not the samples
+    :return: Obspy Trace object
+    """
+    stat = os.stat(rftn)
+    # Copy so callers can process the trace without changing the cache
+    return _load_rftn(rftn, stat.st_mtime_ns, stat.st_size, headonly).copy()
+
+
+def rftn_stream(rftn_list, headonly=False):
     """
-    Take a list of receiver function paths and turn it into an obspy stream
+    Take a list of receiver function paths and turn it into an obspy stream.
+    Files are read concurrently by a thread pool.
     :param rftn_list: list of paths to receiver functions
+    :param headonly: Only read the headers.  Use when just the stats are
+        needed, the traces will have no data
     :return: Obspy Stream object
     """
-    st = Stream()
-    for i, rftn in enumerate(rftn_list):
-        st += read(rftn)
-        st[i].stats['name'] = rftn
-    return st
+    if len(rftn_list) == 0:
+        return Stream()
+    with ThreadPoolExecutor(max_workers=min(16, len(rftn_list))) as ex:
+        traces = list(ex.map(partial(_read_rftn, headonly=headonly),
+                             rftn_list))
+    return Stream(traces=traces)
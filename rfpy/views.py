@@ -1,8 +1,23 @@
+import csv
+import errno
+import hashlib
+import json
+import multiprocessing
 import os
-from shutil import copyfile
-from threading import Thread
-
-from flask import render_template, request, url_for, flash, redirect, jsonify
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from itertools import groupby
+from shutil import copyfile, rmtree
+from threading import Lock, Thread
+
+from flask import render_template, request, url_for, flash, redirect, jsonify,\
+                  send_from_directory, abort, Response, stream_with_context
+from sqlalchemy import event as sa_event, func, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import configure_mappers, joinedload
 from rfpy import app, db
 from .hkstack import HKStack
 from rfpy.data import _async_get_data
@@ -13,11 +28,245 @@ from rfpy.plotting import rftn_plot, station_map, hk_map, sta_total_rf_plot,\
 from rfpy.rftn import _async_rf_calc
 from rfpy.util import rftn_stream
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Downloads run one at a time by default since every job writes the same
+# station and catalog files in BASE_DIR/Data
+_download_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('RFPY_DL_WORKERS', 1)))
+# Download jobs by id.  Finished jobs are dropped after _DL_JOB_TIMEOUT
+# seconds
+_DL_JOB_TIMEOUT = 3600
+_download_jobs = {}
+
+# HK stacks run in the background so the request returns straight away.
+# HKStack draws with pyplot, which isn't thread safe, so one stack runs at a
+# time by default
+_hk_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('RFPY_HK_WORKERS', 1)))
+# HK stack jobs by id.  Finished jobs and their plots are dropped after
+# _HK_JOB_TIMEOUT seconds
+_HK_JOB_TIMEOUT = 3600
+_hk_jobs = {}
+_hk_jobs_lock = Lock()
+# Each hkstack job draws its plot into a directory here named by the job id
+_HK_PLOT_DIR = os.path.join(app.static_folder, 'hkstack')
+
+
+# Matplotlib rendering is CPU bound and holds the GIL, so plots are drawn in
+# worker processes.  The pool is started on first use, with spawn since
+# forking the threaded web server is not safe.  Each worker imports obspy
+# and cartopy, so only a few are started
+_PLOT_WORKERS = int(os.environ.get('RFPY_PLOT_WORKERS',
+                                   min(4, os.cpu_count() or 1)))
+_plot_pool = None
+_plot_pool_lock = Lock()
+
+
+def _get_plot_pool(broken=None):
+    """
+    Return the plot process pool, starting it if needed
+    :param broken: Pool that has broken.  It is replaced with a new pool if
+        it is still the current one
+    """
+    global _plot_pool
+    with _plot_pool_lock:
+        if broken is not None and _plot_pool is broken:
+            broken.shutdown(wait=False)
+            _plot_pool = None
+        if _plot_pool is None:
+            _plot_pool = ProcessPoolExecutor(
+                max_workers=_PLOT_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'))
+    return _plot_pool
+
+
+def _plot_in_process(plot, *args, **kwargs):
+    """
+    Run a plotting function in the plot process pool and wait for it.  If a
+    worker died and broke the pool, the pool is restarted and the plot is
+    tried once more.
+    :param plot: Plotting function from rfpy.plotting
+    :return: Return value of the plotting function
+    """
+    pool = _get_plot_pool()
+    try:
+        return pool.submit(plot, *args, **kwargs).result()
+    except BrokenProcessPool:
+        pool = _get_plot_pool(broken=pool)
+        return pool.submit(plot, *args, **kwargs).result()
+
+
+# Station and filter names for the select menus, cached for a short time
+# since they rarely change.  Inserts and deletes made by this process clear
+# the cache, the timeout catches changes made by the command line tools
+_SELECT_CACHE_TIMEOUT = 60
+_select_cache = {}
+
+
+def _select_options(model, column):
+    """
+    Return (id, name) rows of a table ordered by name for the select menus
+    :param model: Stations or Filters
+    :param column: Column holding the name
+    """
+    key = model.__name__
+    now = time.monotonic()
+    cached = _select_cache.get(key)
+    if cached is None or now - cached[0] >= _SELECT_CACHE_TIMEOUT:
+        rows = db.session.query(model.id, column).order_by(column).all()
+        cached = _select_cache[key] = (now, rows)
+    return cached[1]
+
+
+@sa_event.listens_for(Stations, 'after_insert')
+@sa_event.listens_for(Stations, 'after_delete')
+@sa_event.listens_for(Filters, 'after_insert')
+@sa_event.listens_for(Filters, 'after_delete')
+def _clear_select_cache(mapper, connection, target):
+    _select_cache.pop(type(target).__name__, None)
+
+
+def _request_json():
+    """ Parse the JSON body of the request, with orjson when installed """
+    if orjson is None:
+        return request.json
+    return orjson.loads(request.get_data())
+
+
+def _render_cached(filename, data, render):
+    """
+    Draw a plot with render(path) unless filename was already drawn from the
+    same data.  A hash of the data is kept next to the plot in a .sig file.
+    The plot is drawn to a temporary file and moved into place so a
+    half written file is never served.
+    :param filename: Path of the plot
+    :param data: Everything the plot depends on
+    :param render: Function that saves the plot to its filename argument
+    """
+    sig = hashlib.sha1(repr(data).encode()).hexdigest()
+    sig_file = f'{filename}.sig'
+    if os.path.exists(filename) and os.path.exists(sig_file):
+        with open(sig_file) as f:
+            if f.read() == sig:
+                return
+    # Keep the extension so matplotlib picks the same format.  The file is
+    # left for the plot to create, unlike mkstemp, so it gets the usual
+    # permissions instead of owner only
+    root, ext = os.path.splitext(filename)
+    tmp = f'{root}.{uuid.uuid4().hex}.tmp{ext}'
+    try:
+        render(filename=tmp)
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    with open(sig_file, 'w') as f:
+        f.write(sig)
+
+
+def _link_or_copy(src, dst):
+    """
+    Hard link src to dst, replacing dst if it exists.  Falls back to a copy
+    when the two paths are on different filesystems or links aren't
+    supported.
+    :param src: Existing file
+    :param dst: Path of the new file
+    """
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    # Not created by mkstemp, which would make a copy readable by the owner
+    # only.  The link or copy creates it with the usual permissions
+    tmp = f'{dst}.{uuid.uuid4().hex}.tmp'
+    try:
+        try:
+            os.link(src, tmp)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM):
+                raise
+            copyfile(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def _sse_job_stream(jobs, job_id, status, interval=2, timeout=None):
+    """
+    Server sent events reporting the state of a background job.  An event is
+    sent whenever the state or the extra status changes, with a comment line
+    as a heartbeat in between.  The stream ends when the job finishes or,
+    with a timeout, when nothing has changed for that long.
+    :param jobs: Dictionary of jobs by id, each holding its future
+    :param job_id: Id of the job to report on
+    :param status: Function of the job and its state returning extra fields
+        for each event
+    :param interval: Seconds between checks of the job
+    :param timeout: Seconds without a change before the stream ends
+    """
+    if job_id not in jobs:
+        abort(404)
+    job = jobs[job_id]
+
+    def events():
+        last, changed, beat = None, time.monotonic(), time.monotonic()
+        while True:
+            future = job['future']
+            if future.done():
+                exc = future.exception()
+                state = 'error' if exc else 'done'
+            else:
+                exc = None
+                state = 'running' if future.running() else 'queued'
+            event = {'job': job_id, 'state': state}
+            event.update(status(job, state))
+            if exc:
+                event['error'] = str(exc)
+            now = time.monotonic()
+            if event != last:
+                last, changed, beat = event, now, now
+                yield f'data: {json.dumps(event)}\n\n'
+            elif now - beat >= 15:
+                beat = now
+                yield ': keep-alive\n\n'
+            if state in ('done', 'error'):
+                return
+            if timeout is not None and now - changed >= timeout:
+                return
+            time.sleep(interval)
+
+    return Response(stream_with_context(events()),
+                    mimetype='text/event-stream')
+
+
+def _status_counts():
+    """
+    Count stations per status in the database rather than loading every row
+    to count in python
+    :return: Dictionary of status to number of stations
+    """
+    return dict(db.session.query(Stations.status, func.count(Stations.id))
+                .group_by(Stations.status).all())
+
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
-    stations = Stations.query.order_by(Stations.station).all()
-    total_sta = len(stations)
+    counts = _status_counts()
+    total_sta = sum(counts.values())
+    # Nothing else is shown until stations have been added
+    # Download job started from getData, followed through its progress
+    job = request.args.get('job')
+    if job not in _download_jobs:
+        job = None
+    if total_sta == 0:
+        return render_template('index.html', job=job)
+
     status = ProgressStatus.query
     dl_query = status.filter_by(name='download').first()
     rf_query = status.filter_by(name='rf').first()
@@ -32,30 +281,25 @@ def index():
     else:
         rf_stat = 0
 
-    if total_sta == 0:
-        return render_template('index.html')
-
-    todo, hk, qc = 0, 0, 0
-
     dl_status_file = os.path.join(app.config['BASE_DIR'], 'Data/.stat.txt')
     if os.path.exists(dl_status_file):
         with open(dl_status_file) as f:
             dl_stat = f.read()
 
-    for sta in stations:
-        if sta.status == 'H':
-            hk += 1
-            qc += 1
-        elif sta.status == 'Q':
-            qc += 1
-        else:
-            todo += 1
+    # Stations with an HK stack have also passed QC
+    hk = counts.get('H', 0)
+    qc = hk + counts.get('Q', 0)
+    todo = total_sta - qc
+    # The table only shows the name and status of each station
+    stations = db.session.query(Stations.station, Stations.status)\
+        .order_by(Stations.station).all()
     status = {'total': total_sta, 'todo': todo, 'hk': hk, 'qc': qc,
               'qcpercent': int(100*(qc/total_sta)),
               'todopercent': int(100*(todo/total_sta)),
               'hkpercent': int(100*(hk/total_sta)),
               'dlpercent': dl_stat, 'rfpercent': rf_stat}
-    return render_template('index.html', status=status, stations=stations)
+    return render_template('index.html', status=status, stations=stations,
+                           job=job)
 
 
 @app.route('/stations')
@@ -66,8 +310,8 @@ def stations():
 
 @app.route('/qc', methods=['GET', 'POST'])
 def qc():
-    stations = Stations.query.order_by(Stations.station).all()
-    filters = Filters.query.order_by(Filters.filter).all()
+    stations = _select_options(Stations, Stations.station)
+    filters = _select_options(Filters, Filters.filter)
 
     if request.method == 'POST':
         sta = request.form['staselect']
@@ -75,50 +319,47 @@ def qc():
         start_time = request.form['starttime']
         end_time = request.form['endtime']
 
-        if request.form['selectAll'] == 'yes':
-            rf_query = db.session.query(ReceiverFunctions).join(
-                                        Stations).join(Filters).filter(
-                                        Stations.station == sta).filter(
-                                        Filters.filter == filt)
-            rfs = [[rftn.path, rftn.accepted, rftn.id] for rftn in rf_query]
-
-        elif request.form['selectAll'] == 'new':
-            rf_query = db.session.query(ReceiverFunctions).join(Stations).join(
-                                Filters).filter(
-                                Stations.station == sta).filter(
-                                Filters.filter == filt).filter(
-                                ReceiverFunctions.new_receiver_function
-                                == True) # noqa
-            rfs = [[rftn.path, rftn.accepted, rftn.id] for rftn in rf_query]
-        else:
-            rf_query = db.session.query(ReceiverFunctions).join(Stations).join(
-                                Filters).filter(
-                                Stations.station == sta).filter(
-                                Filters.filter == filt).filter(
-                                ReceiverFunctions.accepted == True) # noqa
-            rfs = [[rftn.path, rftn.accepted, rftn.id] for rftn in rf_query]
+        rf_query = db.session.query(ReceiverFunctions.path,
+                                    ReceiverFunctions.accepted,
+                                    ReceiverFunctions.id).join(
+                                    Stations).join(Filters).filter(
+                                    Stations.station == sta).filter(
+                                    Filters.filter == filt)
+        if request.form['selectAll'] == 'new':
+            rf_query = rf_query.filter(
+                            ReceiverFunctions.new_receiver_function
+                            == True) # noqa
+        elif request.form['selectAll'] != 'yes':
+            rf_query = rf_query.filter(
+                            ReceiverFunctions.accepted == True) # noqa
 
         # TODO Remove dependency on "eq?" in name..use tr.stats.channel instead
-        eqt_rf = [rf[0] for rf in rfs if rf[0][-3:] == 'eqt']
-        eqr_rf = [rf[0] for rf in rfs if rf[0][-3:] == 'eqr']
-        accepted = {}
-        for i in rfs:
-            tmp = i[0].split('/')[-1]
-            accepted[tmp] = [i[1], i[2]]
-        eqt_stream = rftn_stream(eqt_rf)
-        eqr_stream = rftn_stream(eqr_rf)
-        rftn_plots = rftn_plot(eqr_stream, eqt_stream, start_time, end_time,
-                               base_path=app.root_path)
+        # Select each component in the database so other files are never
+        # fetched
+        eqt_rf, eqr_rf, accepted = [], [], {}
+        for paths, suffix in ((eqt_rf, '%eqt'), (eqr_rf, '%eqr')):
+            for path, acc, rf_id in rf_query.filter(
+                    ReceiverFunctions.path.like(suffix)):
+                paths.append(path)
+                accepted[os.path.basename(path)] = (acc, rf_id)
+        # Read both components through one thread pool so the radial files
+        # don't wait for the transverse ones to finish
+        st = rftn_stream(eqt_rf + eqr_rf)
+        eqt_stream = st[:len(eqt_rf)]
+        eqr_stream = st[len(eqt_rf):]
+        rftn_plots = _plot_in_process(rftn_plot, eqr_stream, eqt_stream,
+                                      start_time, end_time,
+                                      base_path=app.root_path)
         rftn_results = []
         for i in rftn_plots:
-            name = i.split('/')[-1]
-            name_rad = name[:-4]
+            name_rad = os.path.basename(i)[:-4]
             name_trans = f"{name_rad[:-1]}t"
             val = accepted[name_rad][0]
             dbid_rad = accepted[name_rad][1]
             dbid_trans = accepted[name_trans][1]
             rftn_results.append([i, val, dbid_rad, dbid_trans, sta])
-            rftn_results.sort(key=lambda x: x[1], reverse=True)
+        # Stable sort, accepted first and otherwise in plot order
+        rftn_results.sort(key=lambda x: x[1], reverse=True)
         return render_template('rftnqc.html', stas=stations, filters=filters,
                                eqrresult=rftn_results)
     return render_template('rftnqc.html', stas=stations, filters=filters)
@@ -127,33 +368,79 @@ def qc():
 @app.route('/doneqc', methods=['GET', 'POST'])
 def doneqc():
     ''' Parses JSON sent from cliet.  JSON contains 2 ids that correspond
-    to the radial and transverse rftn entries in the database.  Selects both
-    entries and sets the values (accepted and new_receiver_function)
+    to the radial and transverse rftn entries in the database.  Updates both
+    entries (accepted and new_receiver_function) and marks the station as
+    quality controlled
     '''
-    for rf in request.json:
-        query_rad = ReceiverFunctions.query.filter_by(id=rf[0]).first()
-        query_trans = ReceiverFunctions.query.filter_by(id=rf[1]).first()
-        query_rad.new_receiver_function = False
-        query_trans.new_receiver_function = False
-        if rf[2]:
-            query_rad.accepted = True
-            query_trans.accepted = True
-        else:
-            query_rad.accepted = False
-            query_trans.accepted = False
-
-    station = request.json[-1][4]
-    query_sta = Stations.query.filter_by(station=station).first()
-    query_sta.status = "Q"
+    rf_status = _request_json()
+    ids = {True: [], False: []}
+    for rf in rf_status:
+        ids[bool(rf[2])].extend(rf[:2])
+    # Update accepted and rejected receiver functions with one statement each
+    # rather than loading every row
+    for accepted, rf_ids in ids.items():
+        if rf_ids:
+            db.session.execute(
+                update(ReceiverFunctions)
+                .where(ReceiverFunctions.id.in_(rf_ids))
+                .values(accepted=accepted, new_receiver_function=False)
+                .execution_options(synchronize_session=False))
+
+    station = rf_status[-1][4]
+    db.session.execute(update(Stations).where(Stations.station == station)
+                       .values(status='Q')
+                       .execution_options(synchronize_session=False))
     db.session.commit()
 
     return redirect(url_for('qc'))
 
 
+def _prune_jobs(jobs, max_age):
+    """
+    Drop finished background jobs that were started more than max_age
+    seconds ago
+    :param jobs: Dictionary of jobs by id, each holding its future and the
+        time.monotonic() it was started at
+    :param max_age: Seconds to keep a job for
+    """
+    now = time.monotonic()
+    for job_id, job in list(jobs.items()):
+        if job['future'].done() and now - job['started'] >= max_age:
+            del jobs[job_id]
+
+
+def _prune_hk_jobs():
+    """
+    Drop finished hkstack jobs older than _HK_JOB_TIMEOUT.  Plot directories
+    of jobs that are no longer known, including any left from before a
+    restart, are removed.  Call with _hk_jobs_lock held.
+    """
+    _prune_jobs(_hk_jobs, _HK_JOB_TIMEOUT)
+    if os.path.isdir(_HK_PLOT_DIR):
+        for name in os.listdir(_HK_PLOT_DIR):
+            if name not in _hk_jobs:
+                rmtree(os.path.join(_HK_PLOT_DIR, name), ignore_errors=True)
+
+
+def _run_hkstack(job, rfs, **kwargs):
+    """
+    Read the receiver functions and run the HK stack for an hkstack job.
+    The job's stage is updated as it goes for the progress stream.
+    :param job: Job dictionary from _hk_jobs
+    :param rfs: Receiver function paths to stack
+    :return: Max H, sigma H, max K and sigma K
+    """
+    job['stage'] = 'reading'
+    st = rftn_stream(rfs)
+    job['stage'] = 'stacking'
+    hk = HKStack(st, **kwargs)
+    return [hk.maxh, hk.sigmah, hk.maxk, hk.sigmak]
+
+
 @app.route('/hkstack', methods=['GET', 'POST'])
 def hkstack():
-    stations = Stations.query.order_by(Stations.station).all()
-    filters = Filters.query.order_by(Filters.filter).all()
+    stations = _select_options(Stations, Stations.station)
+    filters = _select_options(Filters, Filters.filter)
 
     if request.method == 'POST':
         sta = request.form['staselect']
@@ -177,37 +464,115 @@ def hkstack():
             do_boot = True
         else:
             do_boot = False
-        rf_query = db.session.query(ReceiverFunctions).join(
+        # Only accepted radial receiver functions are stacked
+        rf_query = db.session.query(ReceiverFunctions.path).join(
                                     Stations).join(Filters).filter(
                                     Stations.station == sta).filter(
-                                    Filters.filter == filt)
-        rfs = [rftn.path for rftn in rf_query
-               if rftn.accepted is True and rftn.path[-1] == 'r']
+                                    Filters.filter == filt).filter(
+                                    ReceiverFunctions.accepted
+                                    == True).filter( # noqa
+                                    ReceiverFunctions.path.like('%r'))
+        rfs = [path for (path,) in rf_query]
 
         if len(rfs) == 0:
             flash('No accepted receiver functions!  Add receiver functions and'
                   'perform quality control')
             return redirect(url_for('hkstack'))
 
-        st = rftn_stream(rfs)
-        hk = HKStack(st, station=sta, vp=vp, depth_range=(h_ini, h_fin),
-                     kappa_range=(k_ini, k_fin), w1=w1, w2=w2, w3=w3, pws=pws,
-                     bs=do_boot, starttime=plot_ts, endtime=plot_tf,
-                     plotfile=os.path.join(app.root_path,
-                     f'static/{sta}_{filt}_hkstack.svg'))
-        plot = hk.plotfile
-        plot = f'static/{plot.split("/")[-1]}'
-        hk_vals = [hk.maxh, hk.sigmah, hk.maxk, hk.sigmak, vp]
-        return render_template('hkstack.html', stas=stations, plot=plot,
-                               hk=hk_vals, filters=filters,
-                               w1=w1, w2=w2, w3=w3, vp=vp, startd=h_ini,
-                               endd=h_fin, startk=k_ini, endk=k_fin, pws=pws,
-                               bs=do_boot, starttime=plot_ts, endtime=plot_tf,
-                               staval=sta, filtval=filt, newform=0)
+        # The stack runs in the background and the page follows it through
+        # hkstack_progress, then loads the result from hkresult.  Each job
+        # draws into its own directory so results never share a plot
+        job_id = uuid.uuid4().hex
+        plot_dir = os.path.join(_HK_PLOT_DIR, job_id)
+        plotfile = os.path.join(plot_dir, f'{sta}_{filt}_hkstack.svg')
+        form = {'w1': w1, 'w2': w2, 'w3': w3, 'vp': vp, 'startd': h_ini,
+                'endd': h_fin, 'startk': k_ini, 'endk': k_fin, 'pws': pws,
+                'bs': do_boot, 'starttime': plot_ts, 'endtime': plot_tf,
+                'staval': sta, 'filtval': filt}
+        job = {'stage': 'queued', 'form': form, 'plotfile': plotfile,
+               'started': time.monotonic()}
+        # The lock keeps another request's pruning from removing the new
+        # directory before the job is registered
+        with _hk_jobs_lock:
+            _prune_hk_jobs()
+            os.makedirs(plot_dir)
+            job['future'] = _hk_executor.submit(
+                _run_hkstack, job, rfs, station=sta, vp=vp,
+                depth_range=(h_ini, h_fin), kappa_range=(k_ini, k_fin),
+                w1=w1, w2=w2, w3=w3, pws=pws, bs=do_boot,
+                starttime=plot_ts, endtime=plot_tf, plotfile=plotfile)
+            _hk_jobs[job_id] = job
+        return render_template('hkstack.html', stas=stations,
+                               filters=filters, job=job_id, newform=0, **form)
     return render_template('hkstack.html', stas=stations, filters=filters,
                            newform=1)
 
 
+@app.route('/hkstack/<job_id>')
+def hkresult(job_id):
+    """ Show the result of an hkstack job """
+    job = _hk_jobs.get(job_id)
+    if job is None:
+        abort(404)
+    stations = _select_options(Stations, Stations.station)
+    filters = _select_options(Filters, Filters.filter)
+    future = job['future']
+    if not future.done():
+        return render_template('hkstack.html', stas=stations,
+                               filters=filters, job=job_id, newform=0,
+                               **job['form'])
+    if future.exception():
+        flash(f'HK stack failed: {future.exception()}')
+        return redirect(url_for('hkstack'))
+
+    try:
+        mtime = os.stat(job['plotfile']).st_mtime_ns
+    except FileNotFoundError:
+        flash('The HK stack plot no longer exists.  Please compute it again')
+        return redirect(url_for('hkstack'))
+    plot_name = os.path.relpath(job['plotfile'], _HK_PLOT_DIR)
+    plot = f'static/hkstack/{plot_name}'
+    # The modification time in the URL lets the browser cache the plot
+    # until it is recomputed
+    plot_url = url_for('hkplots', filename=plot_name, v=mtime)
+    hk_vals = future.result() + [job['form']['vp']]
+    return render_template('hkstack.html', stas=stations, plot=plot,
+                           plot_url=plot_url, hk=hk_vals, filters=filters,
+                           newform=0, **job['form'])
+
+
+@app.route('/hkstack/progress/<job_id>')
+def hkstack_progress(job_id):
+    """
+    Server sent events reporting the stage of an hkstack job.  An event is
+    sent whenever the stage changes, with a comment line as a heartbeat in
+    between.  The last event has the URL of the result page.
+    """
+    result_url = url_for('hkresult', job_id=job_id)
+
+    def status(job, state):
+        if state in ('done', 'error'):
+            return {'stage': job['stage'], 'url': result_url}
+        return {'stage': job['stage']}
+
+    return _sse_job_stream(_hk_jobs, job_id, status, interval=0.5)
+
+
+@app.route('/hkplots/<path:filename>')
+def hkplots(filename):
+    """
+    Serve HK stack plots.  Plot URLs that include the file's modification
+    time are safe to cache for a long time.  Conditional requests get a 304
+    when the file is unchanged.
+    """
+    if 'v' not in request.args:
+        return send_from_directory(_HK_PLOT_DIR, filename, conditional=True)
+    r = send_from_directory(_HK_PLOT_DIR, filename, conditional=True,
+                            max_age=31536000)
+    r.cache_control.immutable = True
+    return r
+
+
 @app.route('/savehk', methods=["GET", "POST"])
 def savehk():
     '''
@@ -215,7 +580,7 @@ def savehk():
     database to reflect the calculated values.  If no entry in the database
     create one.  Otherwise, update the entry.
     '''
-    payload = request.json
+    payload = _request_json()
     sta = payload['sta']
     filt = payload['filt']
     if payload['sigmah'] == 'None':
@@ -224,36 +589,34 @@ def savehk():
     else:
         sigmah = float(payload['sigmah'])
         sigmak = float(payload['sigmak'])
+    # Look both ids up in one query first.  An unknown station or filter
+    # would otherwise be inserted as NULL, which the unique index doesn't
+    # catch
+    ids = db.session.query(Stations.id, Filters.id).filter(
+                           Stations.station == sta,
+                           Filters.filter == filt).first()
+    if ids is None:
+        abort(404)
+    sta_id, filt_id = ids
     path_to_save = app.config['BASE_PLOT_PATH']
     saved_hk = f'{path_to_save}{payload["fname"]}'
-    copyfile(f'{app.root_path}/{payload["hkpath"]}', saved_hk)
-    query = db.session.query(HKResults).join(Stations).join(Filters).filter(
-                            Stations.station == sta).filter(
-                            Filters.filter == filt).first()
-    if query:
-        query.h = payload['maxh']
-        query.k = payload['maxk']
-        query.sigmah = payload['sigmah']
-        query.sigmak = payload['sigmak']
-        query.vp = payload['vp']
-        query.hkpath = payload['hkpath']
-        # Grab station from query.id in order to update status column
-        sta_query = Stations.query.filter_by(id=query.station).first()
-        sta_query.status = "H"
-    else:
-        sta_id = Stations.query.filter_by(station=sta).first().id
-        filt_id = Filters.query.filter_by(filter=filt).first().id
-        hk = HKResults(station=sta_id, filter=filt_id,
-                       hkpath=payload['hkpath'], savedhkpath=saved_hk,
-                       h=float(payload['maxh']),
-                       sigmah=sigmah,
-                       k=float(payload['maxk']),
-                       sigmak=sigmak,
-                       vp=float(payload['vp']))
-        db.session.add(hk)
-        # Grab station from query.id in order to update status column
-        sta_query = Stations.query.filter_by(id=sta_id).first()
-        sta_query.status = "H"
+    # Saved before the database is touched so a missing plot fails the save
+    _link_or_copy(f'{app.root_path}/{payload["hkpath"]}', saved_hk)
+    # The job's own plot is removed with the job, so both paths point at
+    # the saved copy
+    values = {'hkpath': saved_hk, 'h': float(payload['maxh']),
+              'sigmah': sigmah, 'k': float(payload['maxk']),
+              'sigmak': sigmak, 'vp': float(payload['vp'])}
+    # Insert the result, or update it if the station and filter already have
+    # one, without selecting it first
+    stmt = insert(HKResults).values(station=sta_id, filter=filt_id,
+                                    savedhkpath=saved_hk, **values)
+    db.session.execute(stmt.on_conflict_do_update(
+                            index_elements=['station', 'filter'],
+                            set_=values))
+    db.session.execute(update(Stations).where(Stations.id == sta_id)
+                       .values(status='H')
+                       .execution_options(synchronize_session=False))
 
     db.session.commit()
     return redirect(url_for('index'))
@@ -267,21 +630,18 @@ def plots():
 @app.route('/stationmap')
 def stationmap():
     """ View for stationmap plot """
-    stations = Stations.query.all()
+    # Only the coordinate and name columns are needed for the map
+    stations = db.session.query(Stations.latitude, Stations.longitude,
+                                Stations.station).all()
     if len(stations) == 0:
         flash('No station data in database...Please download or add data')
         return redirect(url_for('index'))
-    sta_lats = []
-    sta_lons = []
-    sta_names = []
-    for sta in stations:
-        sta_lats.append(sta.latitude)
-        sta_lons.append(sta.longitude)
-        sta_names.append(sta.station)
-
-    station_map(sta_lats, sta_lons, sta_names=sta_names,
-                filename=os.path.join(app.root_path,
-                                      'static', 'station_map.svg'))
+    sta_lats, sta_lons, sta_names = map(list, zip(*stations))
+
+    _render_cached(os.path.join(app.root_path, 'static', 'station_map.svg'),
+                   stations, partial(_plot_in_process, station_map,
+                                     sta_lats, sta_lons,
+                                     sta_names=sta_names))
 
     plot = "static/station_map.svg"
 
@@ -292,33 +652,34 @@ def stationmap():
 def hkmap():
     ''' View to plot depth and kappa maps'''
     plots = []
-    filt_query = Filters.query.all()
-    for filt in filt_query:
-        f = filt.id
-        sta_query = HKResults.query.filter_by(filter=f).all()
-        if len(sta_query) == 0:
-            continue
-        sta_lats = []
-        sta_lons = []
-        sta_names = []
-        depth_vals = []
-        kappa_vals = []
-        for sta in sta_query:
-            sta_lats.append(sta.hk_station.latitude)
-            sta_lons.append(sta.hk_station.longitude)
-            sta_names.append(sta.hk_station.station)
-            depth_vals.append(sta.h)
-            kappa_vals.append(sta.k)
-
-        depth_plot = f'static/depth_map_{f}.svg'
-        kappa_plot = f'static/kappa_map_{f}.svg'
-        plots.append([depth_plot, kappa_plot])
-        hk_map(sta_lats, sta_lons, depth_vals, sta_names=sta_names,
-               filter=filt.filter,
-               filename=os.path.join(app.root_path, depth_plot))
-        hk_map(sta_lats, sta_lons, kappa_vals, sta_names=sta_names,
-               filter=filt.filter,
-               filename=os.path.join(app.root_path, kappa_plot))
+    # Fetch the results with their station and filter in one joined query
+    # instead of lazy loading the station for every result
+    rows = db.session.query(Filters.id, Filters.filter, Stations.latitude,
+                            Stations.longitude, Stations.station, HKResults.h,
+                            HKResults.k)\
+        .join(HKResults, HKResults.filter == Filters.id)\
+        .join(Stations, HKResults.station == Stations.id)\
+        .order_by(Filters.id).all()
+    # Each map is drawn in the plot process pool.  The threads only wait on
+    # the processes so the depth and kappa maps are drawn at the same time
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        renders = []
+        for (f, filt), filt_rows in groupby(rows, key=lambda r: r[:2]):
+            _, _, sta_lats, sta_lons, sta_names, depth_vals, kappa_vals = \
+                map(list, zip(*filt_rows))
+            depth_plot = f'static/depth_map_{f}.svg'
+            kappa_plot = f'static/kappa_map_{f}.svg'
+            plots.append([depth_plot, kappa_plot])
+            for plot, vals in ((depth_plot, depth_vals),
+                               (kappa_plot, kappa_vals)):
+                renders.append(ex.submit(
+                    _render_cached, os.path.join(app.root_path, plot),
+                    (sta_lats, sta_lons, vals, sta_names, filt),
+                    partial(_plot_in_process, hk_map, sta_lats, sta_lons,
+                            vals, sta_names=sta_names, filter=filt)))
+        # result() re-raises any error from drawing a map
+        for render in renders:
+            render.result()
 
     return render_template('plots.html', plot=plots,
                            format='hk')
@@ -349,31 +710,38 @@ def eqmap():
 
 @app.route('/rfplots', methods=['GET', 'POST'])
 def rfplots():
-    stations = Stations.query.order_by(Stations.station).all()
+    stations = _select_options(Stations, Stations.station)
 
     if request.method == 'POST':
         sta = request.form['staselect']
         plot_start = request.form['startTime']
         plot_end = request.form['endTime']
 
-        sta_id = Stations.query.filter_by(station=sta).first().id
-        filt_query = Filters.query.all()
+        # Accepted receiver functions for every filter in one query, grouped
+        # by filter below
+        rows = db.session.query(Filters.id, Filters.filter,
+                                ReceiverFunctions.path)\
+            .join(ReceiverFunctions, ReceiverFunctions.filter == Filters.id)\
+            .join(Stations, ReceiverFunctions.station == Stations.id)\
+            .filter(Stations.station == sta)\
+            .filter(ReceiverFunctions.accepted == True)\
+            .order_by(Filters.id).all()  # noqa
         plots = []
-        for filt in filt_query:
-            f = filt.id
-            rf_query = ReceiverFunctions.query.filter_by(station=sta_id) \
-                                              .filter_by(filter=f) \
-                                              .filter_by(accepted=True).all()
-            if not rf_query:
-                continue
-            rfs = [rf.path for rf in rf_query]
-            st = rftn_stream(rfs)
-            plot = f'static/{sta}_{filt.filter}_totalPlot.svg'
-            sta_total_rf_plot(st, plot_start=float(plot_start),
-                              plot_end=float(plot_end),
-                              title=f'Station: {sta}    Filter: {filt.filter}',
-                              filename=os.path.join(app.root_path, plot))
-            plots.append(plot)
+        renders = []
+        # Plots for each filter are drawn in parallel in the plot process
+        # pool.  _plot_in_process blocks, so each one waits in a thread
+        with ThreadPoolExecutor(max_workers=_PLOT_WORKERS) as ex:
+            for (f, filt), filt_rows in groupby(rows, key=lambda r: r[:2]):
+                st = rftn_stream([r.path for r in filt_rows])
+                plot = f'static/{sta}_{filt}_totalPlot.svg'
+                renders.append(ex.submit(
+                    _plot_in_process, sta_total_rf_plot, st,
+                    plot_start=float(plot_start), plot_end=float(plot_end),
+                    title=f'Station: {sta}    Filter: {filt}',
+                    filename=os.path.join(app.root_path, plot)))
+                plots.append(plot)
+            for render in renders:
+                render.result()
         return render_template('rfplots.html', plots=plots, stas=stations)
     return render_template('rfplots.html', stas=stations)
 
@@ -390,59 +758,94 @@ def dbAdmin():
 @app.route('/getTables', methods=['GET', 'POST'])
 def getTables():
     table = request.args.get('table')
-    if table == 'hk':
-        data = HKResults.query.all()
-    elif table == 'station':
-        data = Stations.query.all()
-    elif table == 'filter':
-        data = Filters.query.all()
-    elif table == 'rftn':
-        data = ReceiverFunctions.query.all()
-    elif table == 'earthquakes':
-        data = Earthquakes.query.all()
-    elif table == 'arrivals':
-        data = Arrivals.query.all()
-    elif table == 'rawdata':
-        data = RawData.query.all()
-    else:
+    # Backref attributes only exist once the mappers are configured
+    configure_mappers()
+    # Related rows used by as_dict are loaded in the same query
+    tables = {'hk': (HKResults, [HKResults.hk_station, HKResults.hk_filter]),
+              'station': (Stations, []),
+              'filter': (Filters, []),
+              'rftn': (ReceiverFunctions,
+                       [ReceiverFunctions.station_receiver_functions,
+                        ReceiverFunctions.filter_receiver_functions]),
+              'earthquakes': (Earthquakes, []),
+              'arrivals': (Arrivals, [Arrivals.station]),
+              'rawdata': (RawData, [RawData.station])}
+    if table not in tables:
         flash('That table is not available')
         return redirect(url_for('dbAdmin'))
 
-    data_list = [d.as_dict() for d in data]
-    return jsonify(data_list)
+    model, related = tables[table]
+    query = model.query.options(*[joinedload(r) for r in related])
+    dumps = orjson.dumps if orjson else lambda d: json.dumps(d).encode()
+
+    def rows():
+        # Stream the JSON array in batches of rows instead of building the
+        # whole list before sending anything
+        yield b'['
+        for i, row in enumerate(query.yield_per(1000)):
+            yield (b',' if i else b'') + dumps(row.as_dict())
+        yield b']'
+
+    return Response(stream_with_context(rows()), mimetype='application/json')
+
+
+def _round(value, digits):
+    """ Round a value that may be NULL in the database """
+    return None if value is None else round(value, digits)
+
+
+def _write_export(filename, header, query, fmt=None):
+    """
+    Write the rows of a query to a space delimited export file.  Rows are
+    fetched from the database in batches instead of all at once.
+    :param filename: File to write
+    :param header: List of column names
+    :param query: Query returning the columns of the file
+    :param fmt: Optional function applied to each row before writing
+    """
+    rows = query.yield_per(1000)
+    if fmt:
+        rows = map(fmt, rows)
+    # csv writes None as an empty field, which shifts the columns of a space
+    # delimited file.  Write it out as None like the old exports did
+    rows = (['None' if v is None else v for v in row] for row in rows)
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter=' ', lineterminator='\n')
+        writer.writerow(header)
+        writer.writerows(rows)
 
 
 @app.route('/exportData', methods=['GET', 'POST'])
 def exportData():
-    stas = Stations.query.all()
-    hk = HKResults.query.all()
-    eq = Earthquakes.query.all()
-    arr = Arrivals.query.all()
-
-    with open(f'{app.config["BASE_EXPORT_PATH"]}RFTN_Stations.txt', 'w') as f:
-        f.write('Station Latitude Longitude Elevation\n')
-        for s in stas:
-            f.write(f'{s.station} {s.latitude} {s.longitude} {s.elevation}\n')
-
-    with open(f'{app.config["BASE_EXPORT_PATH"]}HK_Results.txt', 'w') as f:
-        f.write('Station Latitude Longitude Elevation Filter Depth SigmaDepth')
-        f.write('Kappa SigmaKappa Vp\n')
-        for i in hk:
-            f.write(f'{i.hk_station.station} {i.hk_station.latitude} ')
-            f.write(f'{i.hk_station.longitude} {i.hk_station.elevation} ')
-            f.write(f'{i.hk_filter.filter} {i.h} {round(i.sigmah, 1)} {i.k} ')
-            f.write(f'{round(i.sigmak, 2)} {i.vp}\n')
-
-    with open(f'{app.config["BASE_EXPORT_PATH"]}RFTN_Eqs.txt', 'w') as f:
-        f.write('Time Latitude Longitude Depth Used\n')
-        for e in eq:
-            f.write(f'{e.origin_time} {e.latitude} {e.longitude} {e.depth} ')
-            f.write(f'{e.utilized}\n')
-
-    with open(f'{app.config["BASE_EXPORT_PATH"]}RFTN_Arrivals.txt', 'w') as f:
-        f.write('Type Time Station Earthquake\n')
-        for a in arr:
-            f.write(f'{a.arr_type} {a.time} {a.station.station} {a.eq_id}\n')
+    export_path = app.config["BASE_EXPORT_PATH"]
+    # Rows are written straight from column queries so no ORM objects are
+    # built
+    sta_rows = db.session.query(Stations.station, Stations.latitude,
+                                Stations.longitude, Stations.elevation)
+    hk_rows = db.session.query(Stations.station, Stations.latitude,
+                               Stations.longitude, Stations.elevation,
+                               Filters.filter, HKResults.h, HKResults.sigmah,
+                               HKResults.k, HKResults.sigmak, HKResults.vp)\
+        .join(Stations, HKResults.station == Stations.id)\
+        .join(Filters, HKResults.filter == Filters.id)
+    eq_rows = db.session.query(Earthquakes.origin_time, Earthquakes.latitude,
+                               Earthquakes.longitude, Earthquakes.depth,
+                               Earthquakes.utilized)
+    arr_rows = db.session.query(Arrivals.arr_type, Arrivals.time,
+                                Stations.station, Arrivals.eq_id)\
+        .join(Stations, Arrivals.station_id == Stations.id)
+
+    _write_export(f'{export_path}RFTN_Stations.txt',
+                  ['Station', 'Latitude', 'Longitude', 'Elevation'], sta_rows)
+    _write_export(f'{export_path}HK_Results.txt',
+                  ['Station', 'Latitude', 'Longitude', 'Elevation', 'Filter',
+                   'Depth', 'SigmaDepth', 'Kappa', 'SigmaKappa', 'Vp'],
+                  hk_rows, lambda r: r[:6] + (_round(r.sigmah, 1), r.k,
+                                              _round(r.sigmak, 2), r.vp))
+    _write_export(f'{export_path}RFTN_Eqs.txt',
+                  ['Time', 'Latitude', 'Longitude', 'Depth', 'Used'], eq_rows)
+    _write_export(f'{export_path}RFTN_Arrivals.txt',
+                  ['Type', 'Time', 'Station', 'Earthquake'], arr_rows)
 
     flash(f'Data saved to {app.config["BASE_EXPORT_PATH"]}')
     return redirect(url_for('index'))
@@ -462,8 +865,11 @@ def getData():
         # pass info to get_data, get_stations etc
         # run in background thread? (celery seems like overkill to have users
         # setup)
-        nets = ','.join(set([s.split('_')[0] for s in stations]))
-        stas = ','.join(set([s.split('_')[1] for s in stations]))
+        # dict.fromkeys drops duplicates but keeps the order the codes were
+        # entered in, so repeated requests send the same string
+        codes = [s.split('_', 1) for s in stations]
+        nets = ','.join(dict.fromkeys(c[0] for c in codes))
+        stas = ','.join(dict.fromkeys(c[1] for c in codes))
         kw = {'starttime': start_time,
               'endtime': end_time,
               'network': nets,
@@ -476,15 +882,39 @@ def getData():
             kw['username'] = username
             kw['password'] = password
 
-        Thread(target=_async_get_data, args=(app,), kwargs=kw).start()
+        _prune_jobs(_download_jobs, _DL_JOB_TIMEOUT)
+        job_id = uuid.uuid4().hex
+        _download_jobs[job_id] = {
+            'future': _download_executor.submit(_async_get_data, app, **kw),
+            'started': time.monotonic()}
 
         flash(f'Your data will be downloaded')
+        # The index page follows the job through the progress stream
+        index_url = url_for('index', job=job_id)
         return (f'<p>Loading...</p><script> let timer=setTimeout(()=>'
-                f'{{window.location="{url_for("index")}"}}, 4000)</script>')
+                f'{{window.location="{index_url}"}}, 4000)</script>')
         # return redirect(url_for('index'))
     return render_template('getData.html')
 
 
+@app.route('/progress/<job_id>')
+def progress(job_id):
+    """
+    Server sent events reporting the state of a download job and the
+    download progress.  An event is sent whenever either changes, with a
+    comment line as a heartbeat in between.  The stream ends when the job
+    finishes or nothing has changed for 120 seconds.
+    """
+    def status(job, state):
+        dl_stat = db.session.query(ProgressStatus.progress)\
+            .filter_by(name='download').limit(1).scalar()
+        # End the transaction so the next poll sees new progress
+        db.session.rollback()
+        return {'download': dl_stat}
+
+    return _sse_job_stream(_download_jobs, job_id, status, timeout=120)
+
+
 @app.route('/calc_rf', methods=['POST'])
 def calc_rf():
     # stations = request.form['station'].splitlines()
@@ -521,8 +951,15 @@ def poll_status():
 
 @app.after_request
 def add_header(r):
-    """ Add headers to disable caching """
-    r.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-    r.headers['Pragma'] = 'no-cache'
-    r.headers['Expires'] = '0'
+    """
+    Disable caching of pages and data.  Plots are redrawn under the same
+    names, so other responses must be revalidated before the browser reuses
+    them, unless the view set its own cache headers
+    """
+    if r.mimetype in ('text/html', 'application/json', 'text/event-stream'):
+        r.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+        r.headers['Pragma'] = 'no-cache'
+        r.headers['Expires'] = '0'
+    else:
+        r.headers.setdefault('Cache-Control', 'no-cache')
     return r
@@ -9,6 +9,7 @@ setup(
         'flask',
         'flask-sqlalchemy',
         'numpy',
+        'lxml',
         'obspy',
         'matplotlib',
         'cartopy'